@@ -1,62 +1,518 @@
 """
-status: works great, but could be faster by being multithreaded
+Tools for searching the exports of binary dlls and executables
+
+status: works great.  PE export tables are read directly, falling back
+to dumpbin (in batches, on worker threads) for anything else
 """
 import typing
 import os
+import re
+import json
+import atexit
+import mmap
+import struct
 import subprocess
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor,as_completed
 
 
-def dllExports(dllFilename)->typing.Generator[str,None,None]:
+def _parseExportSections(
+    lines:typing.Iterable[bytes]
+    )->typing.Generator[typing.Tuple[str,typing.List[str]],None,None]:
     """
-    dump the exports lists of a binary dll or executable
+    split the lines of a dumpbin /exports dump into
+    (dumpedFilename,[exports]) for each "Dump of file" section
+
+    Each section is parsed on its own, so a file without an exports
+    table (eg, most exes) gets [] rather than running on into the
+    next file's section.
+
+    (works on the raw bytes so that only the names get decoded)
     """
-    po=subprocess.Popen(['dumpbin','/exports',dllFilename],
-        stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    out,_=po.communicate()
-    lines=out.decode('utf-8',errors='ignore').split('\n')
+    name:typing.Optional[str]=None
+    exports:typing.List[str]=[]
     inExports=False
     for line in lines:
-        if not inExports:
-            if line.startswith('    ordinal hint RVA      name'):
+        if line.startswith(b'Dump of file '):
+            if name is not None:
+                yield name,exports
+            name=line[13:].strip().decode('utf-8',errors='ignore')
+            exports=[]
+            inExports=False
+        elif name is None:
+            continue
+        elif not inExports:
+            if line.startswith(b'    ordinal hint RVA      name'):
                 inExports=True
-        elif line.startswith('  Summary'):
-            return
+        elif line.startswith(b'  Summary'):
+            inExports=False
         else:
-            cols=line.strip().split()
+            cols=line.split()
             if len(cols)>3:
-                yield cols[3]
+                exports.append(cols[3].decode('utf-8',errors='ignore'))
+    if name is not None:
+        yield name,exports
+
+# MSVC linker errors look like either of
+#   unresolved external symbol __imp_foo referenced in function main
+#   unresolved external symbol "int __cdecl foo(void)" (?foo@@YAHXZ) ...
+# where, for C++, the decorated name in parentheses is what gets exported
+_UNRESOLVED_RE=re.compile(
+    rb'unresolved external symbol (?:"[^"]*" \((\S+)\)|(\S+))')
+
+# exports lists are remembered across runs in this file as
+#   {canonicalPath:[mtimeNs,size,[exports]]}
+# (the name is versioned so that entries written by older, buggy,
+# versions of the dumpbin parser are not trusted)
+EXPORTS_CACHE_FILENAME=os.path.join(
+    os.path.expanduser('~'),'.cache','binaryTools','exports.v2.json')
+_exportsCache:typing.Optional[typing.Dict[str,typing.List[typing.Any]]]=None
+_exportsCacheDirty=False
+_exportsCacheLock=threading.Lock()
+
+def _loadExportsCache()->typing.Dict[str,typing.List[typing.Any]]:
+    """
+    get the exports cache, loading it from disk the first time
+
+    (call with _exportsCacheLock held)
+    """
+    global _exportsCache # pylint: disable=global-statement
+    if _exportsCache is None:
+        _exportsCache={}
+        try:
+            with open(EXPORTS_CACHE_FILENAME,'r',encoding='utf-8') as f:
+                _exportsCache=json.load(f)
+        except (OSError,ValueError):
+            pass
+        atexit.register(_saveExportsCache)
+    return _exportsCache
+
+def _saveExportsCache():
+    """
+    write the exports cache to disk, if anything has changed
+    """
+    global _exportsCacheDirty # pylint: disable=global-statement
+    with _exportsCacheLock:
+        if not _exportsCacheDirty or _exportsCache is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(EXPORTS_CACHE_FILENAME),exist_ok=True)
+            with open(EXPORTS_CACHE_FILENAME,'w',encoding='utf-8') as f:
+                json.dump(_exportsCache,f)
+            _exportsCacheDirty=False
+        except OSError:
+            pass
+
+@functools.lru_cache(maxsize=4096)
+def _canon(filename:str)->str:
+    """
+    the cache key for a file
+
+    This resolves symlinks and (on windows) case, so that the same
+    binary reached by different paths is only dumped once.
+    """
+    return os.path.normcase(os.path.realpath(filename))
+
+def _getCachedExports(filename:str)->typing.Optional[typing.List[str]]:
+    """
+    get the exports of a file from the cache
+
+    returns None if it is not there, or the file has since changed
+    """
+    try:
+        st=os.stat(filename)
+    except OSError:
+        return None
+    key=_canon(filename)
+    with _exportsCacheLock:
+        cached=_loadExportsCache().get(key)
+    if cached is None or cached[0]!=st.st_mtime_ns or cached[1]!=st.st_size:
+        return None
+    return cached[2]
+
+def _setCachedExports(filename:str,exports:typing.List[str]):
+    """
+    remember the exports of a file
+    """
+    global _exportsCacheDirty # pylint: disable=global-statement
+    try:
+        st=os.stat(filename)
+    except OSError:
+        return
+    key=_canon(filename)
+    with _exportsCacheLock:
+        _loadExportsCache()[key]=[
+            st.st_mtime_ns,st.st_size,exports]
+        _exportsCacheDirty=True
+
+def _peExports(data:mmap.mmap)->typing.Optional[typing.List[str]]:
+    """
+    read the exported names out of a mapped file
+    (see _readExportsNative)
+
+    raises struct.error, ValueError or IndexError if the file
+    is a PE file, but a broken one
+    """
+    if data[0:2]!=b'MZ':
+        return [] # not a dos/windows executable
+    peOffset=struct.unpack_from('<I',data,0x3C)[0]
+    if data[peOffset:peOffset+4]!=b'PE\0\0':
+        return [] # eg, a plain dos exe
+    numSections,_,_,_,optSize,_=struct.unpack_from(
+        '<HIIIHH',data,peOffset+6)
+    optOffset=peOffset+24
+    magic=struct.unpack_from('<H',data,optOffset)[0]
+    if magic==0x10b: # PE32
+        dirOffset=optOffset+96
+    elif magic==0x20b: # PE32+
+        dirOffset=optOffset+112
+    else:
+        return None
+    if dirOffset+8>optOffset+optSize:
+        return [] # no data directories, so no exports
+    exportRva,exportSize=struct.unpack_from('<II',data,dirOffset)
+    if not exportRva or not exportSize:
+        return []
+    # map virtual addresses to file offsets via the section table
+    sections=[]
+    for i in range(numSections):
+        virtualSize,virtualAddress,rawSize,rawOffset=struct.unpack_from(
+            '<IIII',data,optOffset+optSize+i*40+8)
+        sections.append((virtualAddress,
+            max(virtualSize,rawSize),rawOffset))
+    def rvaToOffset(rva:int)->int:
+        for virtualAddress,size,rawOffset in sections:
+            if virtualAddress<=rva<virtualAddress+size:
+                return rva-virtualAddress+rawOffset
+        raise ValueError(f'RVA {rva:08X} is not in any section')
+    exportDir=rvaToOffset(exportRva)
+    numNames,namesRva=struct.unpack_from('<I4xI',data,exportDir+24)
+    namesOffset=rvaToOffset(namesRva)
+    ret=[]
+    for (nameRva,) in struct.iter_unpack('<I',
+            data[namesOffset:namesOffset+numNames*4]):
+        start=rvaToOffset(nameRva)
+        end=data.find(b'\0',start)
+        ret.append(data[start:end].decode('utf-8',errors='ignore'))
+    return ret
+
+def _readExportsNative(filename:str)->typing.Optional[typing.List[str]]:
+    """
+    read the exported names straight out of a PE file's export directory
+    (no dumpbin required)
+
+    returns [] if it is not a PE file at all (so there are no exports),
+    or None if it is a PE file we don't understand, in which case the
+    caller should fall back to dumpbin
+
+    See also:
+    https://learn.microsoft.com/en-us/windows/win32/debug/pe-format#the-edata-section-image-only # noqa: E501 # pylint: disable=line-too-long
+    """
+    try:
+        with open(filename,'rb') as f:
+            if os.fstat(f.fileno()).st_size<0x40:
+                return [] # too small to be a PE file
+            data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    except (OSError,ValueError):
+        return None
+    try:
+        return _peExports(data)
+    except (struct.error,ValueError,IndexError):
+        return None
+    finally:
+        data.close()
+
+def _dumpbinExports(filenames:typing.List[str])->subprocess.Popen:
+    """
+    start dumpbin on some files, for reading its output
+    line by line as it goes, rather than buffering it all
+    """
+    return subprocess.Popen(['dumpbin','/exports',*filenames],
+        stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,bufsize=1<<20)
+
+def dllExports(dllFilename)->typing.Generator[str,None,None]:
+    """
+    dump the exports lists of a binary dll or executable
+
+    NOTE: PE files are read directly, and dumpbin is only used
+        for anything that can't be read that way
+    NOTE: results are cached (see EXPORTS_CACHE_FILENAME)
+    """
+    exports=_getCachedExports(dllFilename)
+    if exports is None:
+        exports=_readExportsNative(dllFilename)
+        if exports is not None:
+            _setCachedExports(dllFilename,exports)
+    if exports is None:
+        exports=[]
+        try:
+            with _dumpbinExports([dllFilename]) as po:
+                for _,sectionExports in _parseExportSections(po.stdout):
+                    exports.extend(sectionExports)
+        except FileNotFoundError:
+            pass # no dumpbin, so we can't tell (and don't cache that)
+        else:
+            if po.returncode==0:
+                _setCachedExports(dllFilename,exports)
+    yield from exports
+
+def dllExportsBatch(
+    filenames:typing.Iterable[str]
+    )->typing.Dict[str,typing.List[str]]:
+    """
+    dump the exports lists of many binaries with a single
+    dumpbin invocation
+
+    returns {filename:[exports]}
+
+    NOTE: PE files are read directly, and dumpbin is only used
+        for anything that can't be read that way
+    NOTE: results are cached (see EXPORTS_CACHE_FILENAME),
+        and only files not in the cache are dumped
+    """
+    filenames=list(filenames)
+    ret:typing.Dict[str,typing.List[str]]={}
+    toDump=[]
+    for filename in filenames:
+        exports=_getCachedExports(filename)
+        if exports is None:
+            exports=_readExportsNative(filename)
+            if exports is not None:
+                _setCachedExports(filename,exports)
+        if exports is None:
+            ret[filename]=[]
+            toDump.append(filename)
+        else:
+            ret[filename]=exports
+    if not toDump:
+        return ret
+    # dumpbin echoes back each filename in its section header,
+    # so be lenient about how it was spelled
+    lookup={os.path.normcase(os.path.abspath(f)):f for f in toDump}
+    dumped=[]
+    try:
+        with _dumpbinExports(toDump) as po:
+            for name,exports in _parseExportSections(po.stdout):
+                filename=lookup.get(os.path.normcase(os.path.abspath(name)))
+                if filename is not None:
+                    ret[filename]=exports
+                    dumped.append(filename)
+    except FileNotFoundError:
+        pass # no dumpbin, so these stay [] (uncached)
+    else:
+        # a failed (or cut short) run could be missing exports,
+        # so only remember what a clean run said
+        if po.returncode==0:
+            for filename in dumped:
+                _setCachedExports(filename,ret[filename])
+    return ret
+
+def _exportsName(
+    exportNames:typing.FrozenSet[str],
+    filenames:typing.Iterable[str]
+    )->typing.List[typing.Tuple[str,typing.FrozenSet[str]]]:
+    """
+    worker for findExportNamed
+
+    returns (filename,names it exports) for the filenames that
+    export any of exportNames
+    """
+    ret=[]
+    for filename,exports in dllExportsBatch(filenames).items():
+        # isdisjoint() walks the exports once with a hash lookup each,
+        # and stops at the first hit, so misses stay cheap
+        if not exportNames.isdisjoint(exports):
+            ret.append((filename,exportNames.intersection(exports)))
+    return ret
+
+def _findBinaries(
+    paths:typing.Iterable[str],
+    extensions:typing.Iterable[str],
+    maxWorkers:typing.Optional[int]=None
+    )->typing.Generator[str,None,None]:
+    """
+    walk the paths looking for files with the given extensions
+    (extensions are not case sensitive)
+
+    Directories are read on a pool of threads, so that the latency
+    of opening and reading one directory overlaps with the others.
+
+    :maxWorkers: how many directories to read at once
+
+    NOTE: directories that cannot be read are skipped
+    NOTE: files are yielded in the order they are found,
+        not in directory order
+    """
+    if maxWorkers is None:
+        maxWorkers=min(32,(os.cpu_count() or 1)*4)
+    # normalize once, to dotted lowercase like os.path.splitext() gives
+    extensions=frozenset(e.lower() if e.startswith('.') else '.'+e.lower()
+        for e in extensions)
+    roots=[]
+    for p in paths:
+        p=os.path.abspath(os.path.expandvars(p))
+        if os.path.isdir(p):
+            roots.append(p)
+        elif os.path.splitext(p)[1].lower() in extensions:
+            yield p
+    if not roots:
+        return
+    visited=set(roots)
+    visitedLock=threading.Lock()
+    pending:queue.Queue=queue.Queue()
+    found:queue.Queue=queue.Queue()
+    stop=threading.Event()
+    done=object()
+    def scanDir(d:str):
+        # DirEntry knows whether it is a directory without another stat()
+        with os.scandir(d) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    with visitedLock:
+                        if entry.path in visited:
+                            continue
+                        visited.add(entry.path)
+                    pending.put(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in extensions:
+                    found.put(entry.path)
+    def worker():
+        while True:
+            d=pending.get()
+            try:
+                if d is None:
+                    return
+                if not stop.is_set():
+                    scanDir(d)
+            except OSError:
+                pass
+            finally:
+                pending.task_done()
+    def finisher():
+        pending.join()
+        found.put(done)
+        for _ in range(maxWorkers):
+            pending.put(None)
+    for d in roots:
+        pending.put(d)
+    for _ in range(maxWorkers):
+        threading.Thread(target=worker,daemon=True).start()
+    threading.Thread(target=finisher,daemon=True).start()
+    try:
+        while True:
+            filename=found.get()
+            if filename is done:
+                return
+            yield filename
+    finally:
+        # if the caller quits early, let the workers wind down
+        stop.set()
 
 def findExportNamed(
-    exportName,paths,
-    extensions=('.dll','.exe')
+    exportName:typing.Union[str,typing.Iterable[str]],
+    paths:typing.Union[str,typing.Iterable[str]],
+    extensions=('.dll','.exe'),
+    maxWorkers:typing.Optional[int]=None,
+    *,
+    batchSize:int=48,
+    firstMatchOnly:bool=False
     )->typing.Generator[str,None,None]:
     """
     finds all binary files and then searches their exports list
     for a particular symbol
+
+    :exportName: the symbol to look for, or several symbols, in which
+        case files exporting any of them are returned
+    :maxWorkers: how many dumpbin processes to run at once
+        (default is twice the cpu count, since the work is
+        mostly waiting on subprocesses)
+    :batchSize: how many files to hand each dumpbin process
+        (starting dumpbin costs far more than parsing its output)
+    :firstMatchOnly: only yield the first file found for each name,
+        and stop searching once every name has been found
+
+    NOTE: results are yielded in the order they complete,
+        not in directory order
     """
-    visited=set()
-    tape=[]
     if isinstance(paths,str):
         paths=[paths]
-    def processFile(filename)->typing.Generator[str,None,None]:
-        for exp in dllExports(filename):
-            if exp==exportName:
-                yield filename
-                return
-    extensions=set([e.replace('.','') for e in extensions])
-    for p in paths:
-        p=os.path.abspath(os.path.expandvars(p))
-        if os.path.isdir(p):
-            tape.append(p)
-        elif p.rsplit('.',1)[-1] in extensions:
-            processFile(p)
-    while tape:
-        d=tape.pop(0)
-        visited.add(d)
-        for filename in os.listdir(d):
-            filename=os.path.join(d,filename)
-            if os.path.isdir(filename):
-                if filename not in visited:
-                    tape.append(filename)
-            elif filename.rsplit('.',1)[-1] in extensions:
-                yield from processFile(filename)
+    if isinstance(exportName,str):
+        exportNames=frozenset((exportName,))
+    else:
+        exportNames=frozenset(exportName)
+    if maxWorkers is None:
+        maxWorkers=(os.cpu_count() or 1)*2
+    remaining=set(exportNames)
+    def results(future)->typing.Generator[str,None,None]:
+        for filename,hits in future.result():
+            if firstMatchOnly:
+                hits=hits&remaining
+                if not hits:
+                    continue
+                remaining.difference_update(hits)
+            yield filename
+    ex=ThreadPoolExecutor(max_workers=maxWorkers)
+    try:
+        # start dumping batches while the directory walk is still going
+        futures:typing.Set[typing.Any]=set()
+        batch:typing.List[str]=[]
+        binaries=_findBinaries(paths,extensions)
+        for filename in binaries:
+            batch.append(filename)
+            if len(batch)<batchSize:
+                continue
+            futures.add(ex.submit(_exportsName,exportNames,batch))
+            batch=[]
+            if firstMatchOnly:
+                # collect finished batches as we go, so the walk
+                # can quit as soon as every name has been found
+                for future in [f for f in futures if f.done()]:
+                    futures.discard(future)
+                    yield from results(future)
+                if not remaining:
+                    binaries.close()
+                    break
+        if batch and remaining:
+            futures.add(ex.submit(_exportsName,exportNames,batch))
+        for future in as_completed(futures):
+            if firstMatchOnly and not remaining:
+                break
+            yield from results(future)
+    finally:
+        ex.shutdown(wait=True,cancel_futures=True)
+
+def unresolvedSymbols(
+    errString:typing.Union[str,bytes]
+    )->typing.Set[str]:
+    """
+    pick the names of all unresolved external symbols out of
+    MSVC linker output
+
+    (__imp_ prefixes are removed, since the dll exports the bare name)
+    """
+    if isinstance(errString,str):
+        errString=errString.encode('utf-8',errors='ignore')
+    ret=set()
+    # one regex scan over the whole log, rather than splitting lines
+    for m in _UNRESOLVED_RE.finditer(errString):
+        name=(m.group(1) or m.group(2)).decode('utf-8',errors='ignore')
+        if name.startswith('__imp_'):
+            name=name[6:]
+        ret.add(name)
+    return ret
+
+def findExportsInErrorString(
+    errString:typing.Union[str,bytes],
+    paths:typing.Union[str,typing.Iterable[str]],
+    extensions=('.dll','.exe')
+    )->typing.Generator[str,None,None]:
+    """
+    find binaries that export any of the unresolved external symbols
+    mentioned in an MSVC linker error log
+    """
+    symbolNames=unresolvedSymbols(errString)
+    if symbolNames:
+        # one provider per missing symbol is all the linker needs
+        yield from findExportNamed(symbolNames,paths,extensions,
+            firstMatchOnly=True)
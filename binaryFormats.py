@@ -3,10 +3,14 @@ Tools for converting between binary format types
 """
 #import typing
 import os
+import re
 import subprocess
 from .dataBlocks import DataBlock,DataBlocks
 
 
+_IHEX_RE=re.compile(r':[0-9A-Fa-f]{2}\s*[0-9A-Fa-f]{4,99}')
+
+
 def elfFileToIhexFile(filename:str)->str:
     """
     Convert a .elf file into a .hex file
@@ -18,11 +22,11 @@ def elfFileToIhexFile(filename:str)->str:
         or os.path.getmtime(filename)>os.path.getmtime(ihexFilename):
         # (re)generate the ihexFilename file
         cmd=['objcopy','-S','-O','ihex',filename,ihexFilename]
-        po=subprocess.Popen(cmd,shell=True,
-            stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        _,err=po.communicate()
-        errStr=err.decode('utf-8',errors='ignore').strip()
-        if errStr:
+        result=subprocess.run(cmd,capture_output=True,check=False)
+        errStr=result.stderr.decode('utf-8',errors='ignore').strip()
+        if result.returncode or errStr:
+            if not errStr:
+                errStr=f'objcopy returned {result.returncode}'
             raise TypeError('Error converting .elf to .hex: '+errStr)
     return ihexFilename
 
@@ -30,25 +34,25 @@ def elfFileToIhexFile(filename:str)->str:
 def looksLikeIhex(data:bytes)->bool:
     """
     determine if the data looks like intel hex format
+
+    NOTE: data can also be the result of loadBinMmap()
     """
-    if len(data)>=10:
-        asc=data[0:10].decode('ascii')
-        if asc[0]==':':
-            import re
-            exp=r':[0-9A-Fa-f]{2}\s+[[0-9A-Fa-f]{4,99}'
-            if re.match(exp,asc) is not None:
-                return True
+    # memoryview slices do not copy, which matters for big mmaps
+    with memoryview(data) as mv:
+        if len(mv)>=10 and mv[:1]==b':':
+            asc=mv[:10].tobytes().decode('ascii',errors='replace')
+            return _IHEX_RE.match(asc) is not None
     return False
 
 
 def looksLikeElf(data:bytes)->bool:
     """
     determine if the data looks like elf format
+
+    NOTE: data can also be the result of loadBinMmap()
     """
-    if len(data)>=4:
-        asc=data[1:4].decode('ascii')
-        return asc==b'ELF'
-    return False
+    with memoryview(data) as mv:
+        return mv[:4]==b'\x7fELF'
 
 
 def loadIhex(filename:str)->DataBlocks:
@@ -64,12 +68,12 @@ def loadIhex(filename:str)->DataBlocks:
         print('intelhex library (for .hex format) was not found.  Try:')
         print('    pip install intelhex')
         raise e
-    ret=DataBlocks()
     ihex=intelhex.IntelHex(filename)
-    for start,stop in ihex.segments():
-        data=bytes(ihex.tobinarray(start,stop))
-        ret.append(DataBlock(start,data)) # type: ignore
-    return ret
+    # NOTE: segments() gives exclusive stops, but tobinstr() wants
+    #   an inclusive end
+    return DataBlocks(
+        DataBlock(start,ihex.tobinstr(start=start,end=stop-1))
+        for start,stop in ihex.segments())
 
 
 # since it supports elf files, let's be lazy
@@ -54,12 +54,12 @@ def gprof(
     if callGraph:
         cmd.append('-q')
     if sourceDirectories:
-        cmd.append('-I '+(';'.join(sourceDirectories)))
-    cmd.append(f'"{filename}"')
+        cmd.append('-I'+(';'.join(sourceDirectories)))
+    cmd.append(filename)
     print(cmd)
-    po=subprocess.Popen(cmd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
-    out,_=po.communicate()
-    return out.decode('UTF-8',errors='ignore')
+    result=subprocess.run(cmd,
+        stderr=subprocess.STDOUT,stdout=subprocess.PIPE,check=False)
+    return result.stdout.decode('UTF-8',errors='ignore')
 
 
 def listExports(filename:str,data:typing.Optional[bytes])->typing.List[str]:
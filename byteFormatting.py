@@ -2,7 +2,17 @@
 Tools for formatting bytes as strings
 """
 import typing
+import os
 import re
+import mmap
+from codecs import escape_decode # type: ignore
+
+
+_RE_ANSI=re.compile(r'\033\[[0-9;]{1,6}m')
+_RE_LINESTART=re.compile(r"^[^\s]*",re.MULTILINE)
+_RE_DEFAULT_SEP=re.compile(r"(?: |\t|,)+")
+# separators that str2Bytes ignores
+_STRIP_TBL=str.maketrans('','',', \t\r\n')
 
 
 def str2Bytes(s:typing.Union[bytes,bytearray,str]):
@@ -17,7 +27,7 @@ def str2Bytes(s:typing.Union[bytes,bytearray,str]):
         "410dff..." # always assumes hex (not decimal)
         "b'A\r\xFF'" # python bytes dump
         "0b10001000" # binary numbers
-        "0o777" # octal numbers
+        "0o101 0o102" # octal numbers (3 digits per byte)
         NOTE: does not support decimal numbers
             (because, "how big is it?")
 
@@ -30,29 +40,30 @@ def str2Bytes(s:typing.Union[bytes,bytearray,str]):
     """
     if isinstance(s,(bytes,bytearray)):
         s=s.decode('utf-8',errors='ignore')
-    s=s.replace(',','').replace(' ','').replace('\t','')\
-        .replace('\r','').replace('\n','')
+    s=s.translate(_STRIP_TBL)
     if s.startswith("b'"): # python b strings
-        # mitigate against injection attacks
-        s="b'"+s.split("'",2)[1]+"'"
-        # use the interpreter to decode it
-        b=eval(s) # pylint: disable=eval-used
+        # decode the escapes the same way the interpreter would
+        # for a bytes literal (but without evaluating anything)
+        b=escape_decode(s.split("'",2)[1].encode('latin-1'))[0]
     elif s.startswith('0b'): # binary
         s=s.replace('0b','')
-        s=s[2:]
-        while len(s)%8!=0:
-            s='0'+s
-        b=bytes(int(s[i:i+8],2) for i in range(0,len(s),8))
+        if not s:
+            return b''
+        # round up to whole bytes rather than padding the string
+        b=int(s,2).to_bytes((len(s)+7)//8,'big')
     elif s.startswith('0o'): # octal
         s=s.replace('0o','')
-        while len(s)%3!=0:
-            s='0'+s
-        b=bytes(int(s[i:i+3],8) for i in range(0,len(s),3))
+        if len(s)%3!=0:
+            s='0'*(3-len(s)%3)+s
+        # every 3 digits is one byte, so "0o101 0o102" is b'AB', and
+        # leading zero bytes are kept
+        # (bytes() raises ValueError for a group above 0o377)
+        b=bytes([int(s[i:i+3],8) for i in range(0,len(s),3)])
     else: # hex
         s=s.replace('0x','')
         if len(s)%2!=0:
             s='0'+s
-        b=bytes(int(s[i:i+2],16) for i in range(0,len(s),2))
+        b=bytes.fromhex(s)
     return b
 
 def undoByteText(
@@ -80,9 +91,12 @@ def undoByteText(
     do ansiUndoColorize() first
     """
     if sep is None:
-        sep=(' ','\t',',')
-    sep=[re.escape(s) for s in sep]
-    regex=re.compile("("+(")|(".join(sep))+")")
+        regex=_RE_DEFAULT_SEP
+    else:
+        if isinstance(sep,str):
+            sep=(sep,)
+        sep=[re.escape(s) for s in sep]
+        regex=re.compile("(?:"+("|".join(sep))+")+")
     if isinstance(s,(bytes,bytearray)):
         s=s.decode('utf-8',errors='ignore')
     if isinstance(s,str):
@@ -100,6 +114,21 @@ def undoByteText(
         b.extend(str2Bytes(''.join(ss)))
     return bytes(b)
 
+def _hexWithSep(data:bytes,sep:str)->str:
+    """
+    Same as ''.join(['%02X%s'%(b,sep) for b in data])
+    but does the per-byte work in C by way of bytes.hex()
+    """
+    if not data:
+        return ''
+    if not sep:
+        return data.hex().upper()
+    # (bytes.hex() only takes a single ascii separator)
+    if len(sep)==1 and sep.isascii() and sep.upper()==sep:
+        return data.hex(sep).upper()+sep
+    hexStr=data.hex().upper()
+    return sep.join([hexStr[i:i+2] for i in range(0,len(hexStr),2)])+sep
+
 def byteText(
     data:bytes,
     lineLength:typing.Optional[int]=32,
@@ -125,39 +154,69 @@ def byteText(
     :sep: separator between bytes
     :lineSep: separator between lines
     """
-    ret=['%02X%s'%(b,sep) for b in data]
+    hexStr=_hexWithSep(data,sep)
+    charsPerByte=2+len(sep)
     if lineLength is not None:
-        lines=[]
-        for lineIdx in range(0,len(ret),lineLength):
-            lines.append(''.join(ret[lineIdx:lineIdx+lineLength]))
+        charsPerLine=lineLength*charsPerByte
+        lines=[hexStr[lineIdx:lineIdx+charsPerLine]
+            for lineIdx in range(0,len(hexStr),charsPerLine)]
         if lineNumberWidth>=0:
             if lineNumberWidthAutoextend:
                 x=len(str(len(lines)+lineNumberStartAt))
                 if x>lineNumberWidth:
                     lineNumberWidth=x
-            for i,line in enumerate(lines):
-                if lineNumberIsByteOffset:
-                    lines[i]=f"%0{lineNumberWidth}X%s%s"%(
-                        (i+lineNumberStartAt)*lineLength,sep,line)
-                else:
-                    lines[i]=f"%0{lineNumberWidth}d%s%s"%(
-                        i+lineNumberStartAt,sep,line)
+            # build the format once, rather than once per line
+            escapedSep=sep.replace('%','%%')
+            if lineNumberIsByteOffset:
+                fmt=f"%0{lineNumberWidth}X{escapedSep}%s"
+                lines=[fmt%((i+lineNumberStartAt)*lineLength,line)
+                    for i,line in enumerate(lines)]
+            else:
+                fmt=f"%0{lineNumberWidth}d{escapedSep}%s"
+                lines=[fmt%(i+lineNumberStartAt,line)
+                    for i,line in enumerate(lines)]
         return lineSep.join(lines)
-    return ret
+    return [hexStr[i:i+charsPerByte]
+        for i in range(0,len(hexStr),charsPerByte)]
 
 def loadBin(filename:str)->bytes:
     """
     Shorcut to load a binary file as bytes
+
+    NOTE: this reads the entire file into memory.  For large files
+    consider loadBinMmap(), or loadBinPrefix() if you only need to
+    look at the beginning (eg, to sniff out the file format)
     """
     with open(filename,"rb") as f:
         return f.read()
 
+def loadBinPrefix(filename:str,numBytes:int)->bytes:
+    """
+    Load only the first numBytes of a binary file
+    """
+    with open(filename,"rb") as f:
+        return f.read(numBytes)
+
+def loadBinMmap(filename:str)->typing.Union[bytes,mmap.mmap]:
+    """
+    Map a binary file into memory read-only, rather than loading it.
+
+    The result can be indexed and sliced like bytes, but pages are
+    only read from disk as they are touched.
+
+    NOTE: empty files cannot be mapped, so they return b''
+    """
+    with open(filename,"rb") as f:
+        if os.fstat(f.fileno()).st_size==0:
+            return b''
+        # the mmap holds its own handle, so it is fine to close the file
+        return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
 def ansiUndoColorize(s:str)->str:
     """
     Remove ansi color strings
     """
-    regex=re.compile(r'\033\[[0-9;]{1,6}m')
-    return ''.join(regex.split(s))
+    return ''.join(_RE_ANSI.split(s))
 
 
 def ansiColorize(s:typing.Union[str,typing.Iterable[str]],
@@ -171,12 +230,15 @@ def ansiColorize(s:typing.Union[str,typing.Iterable[str]],
         or a full-fledged escape code
     NOTE: Rules are evaluated in-order, so if things don't look like you
         intend, it's probably an order issue
+    NOTE: Consecutive plain text rules are applied together in a
+        single pass, so they do not color inside each other's matches
     SEE ALSO:
         https://en.wikipedia.org/wiki/ANSI_escape_code#Colors
     """
     if not isinstance(s,str):
         s='\n'.join(s)
     colorReset='\033[0m'
+    literals:typing.Dict[str,str]={} # {text:replacement}
     for k,v in rules:
         if isinstance(v,int):
             if v>=40: # background color
@@ -184,11 +246,28 @@ def ansiColorize(s:typing.Union[str,typing.Iterable[str]],
             else: # foreground color
                 v=f'\033[{v}m'
         if isinstance(k,str):
-            replacement=f'{v}{k}{colorReset}'
-            s=s.replace(k,replacement)
+            if k and k not in literals:
+                literals[k]=f'{v}{k}{colorReset}'
         else:
+            s=_replaceLiterals(s,literals)
             replacement=f'{v}\\g<0>{colorReset}'
             s=k.sub(replacement,s)
+    return _replaceLiterals(s,literals)
+
+def _replaceLiterals(s:str,literals:typing.Dict[str,str])->str:
+    """
+    Replace all of the literal strings in one pass using an alternation
+
+    (literals is cleared afterwards, since they have been applied)
+    """
+    if not literals:
+        return s
+    if len(literals)==1:
+        k,replacement=literals.popitem()
+        return s.replace(k,replacement)
+    regex=re.compile('|'.join(re.escape(k) for k in literals))
+    s=regex.sub(lambda m:literals[m.group(0)],s)
+    literals.clear()
     return s
 
 def example():
@@ -199,7 +278,7 @@ def example():
     print(
         ansiColorize(
             byteText(data,lineLength=66),
-            {"AA":95,"FF":105,re.compile(r"^[^\s]*",re.MULTILINE):46}
+            (("AA",95),("FF",105),(_RE_LINESTART,46))
         )
         )
 
@@ -3,6 +3,13 @@ Data blocks consist of a memory location and set of bytes
 that reside there.
 """
 import typing
+import io
+import bisect
+import re
+
+
+# the line number column at the start of each byteText line
+_HEADER_RE=re.compile(r"^[^\s]*",re.MULTILINE)
 
 
 class DataBlock:
@@ -12,6 +19,8 @@ class DataBlock:
     def __init__(self,address:int,data:bytes):
         self.address=address
         self.data=data
+        # (address,data,repr) of the last time we were repr'd
+        self._reprCache:typing.Optional[typing.Tuple[int,bytes,str]]=None
 
     @property
     def startAddress(self)->int:
@@ -38,22 +47,34 @@ class DataBlock:
     def __repr__(self):
         """
         Dumps as a byte table
+
+        NOTE: the result is remembered until address or data
+            are reassigned (only when data is immutable bytes)
         """
+        cache=self._reprCache
+        if cache is not None \
+            and cache[0]==self.address and cache[1] is self.data:
+            return cache[2]
         from byteFormatting import byteText,ansiColorize
-        import re
-        return ansiColorize(
+        ret=ansiColorize(
             byteText(self.data,
                 lineNumberStartAt=self.address,lineLength=32),
-            {re.compile(r"^[^\s]*",re.MULTILINE):46}
+            ((_HEADER_RE,46),)
             )
+        if isinstance(self.data,bytes):
+            self._reprCache=(self.address,self.data,ret)
+        return ret
 
 
 class DataBlocks:
     """
     Set of data blocks
+
+    Blocks are always kept sorted by address
     """
     def __init__(self,dataBlocks:typing.Iterable[DataBlock]=()):
         self.blocks:typing.List[DataBlock]=[]
+        self._starts:typing.List[int]=[] # parallel to self.blocks
         if dataBlocks:
             self.append(dataBlocks)
 
@@ -65,11 +86,33 @@ class DataBlocks:
         Add more data blocks
         """
         if isinstance(block,DataBlock):
-            self.blocks.append(block)
+            idx=bisect.bisect_right(self._starts,block.address)
+            self._starts.insert(idx,block.address)
+            self.blocks.insert(idx,block)
         else:
             self.blocks.extend(block)
+            self.blocks.sort(key=lambda b:b.address)
+            self._starts=[b.address for b in self.blocks]
     add=append
     extend=append
 
+    def find(self,address:int)->typing.Optional[DataBlock]:
+        """
+        Find the data block containing an address
+
+        returns None if no block covers it
+        """
+        idx=bisect.bisect_right(self._starts,address)-1
+        if idx>=0 and self.blocks[idx].endAddress>address:
+            return self.blocks[idx]
+        return None
+
     def __repr__(self):
-        return '\n\n'.join([repr(block) for block in self.blocks])
+        buf=io.StringIO()
+        first=True
+        for block in self.blocks:
+            if not first:
+                buf.write('\n\n')
+            buf.write(repr(block))
+            first=False
+        return buf.getvalue()
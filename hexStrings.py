@@ -2,39 +2,143 @@
 Tools for managing strings containing hex data
 """
 import typing
+import io
+import functools
 import re
+import struct
 
 
-def iterbytes(
-    data:typing.Union[bytes,bytearray],
-    startPos:int=0,endPos:int=-1,
+# struct formats for the chunk sizes it can unpack for us (big endian)
+_CHUNK_FORMATS={2:'>H',4:'>I',8:'>Q'}
+# bytes.translate() tables for the ascii column, by unprintable char
+_TRANS_CACHE:typing.Dict[int,bytes]={}
+
+
+def _dataRange(
+    datalen:int,
+    startPos:int,endPos:int,
     chunkSize:int=1
-    )->typing.Generator[int,None,None]:
+    )->typing.Tuple[int,int]:
     """
-    Utility to iterate over bytes in an array.
+    Resolve a slice-like [startPos:endPos] (negatives count from the end)
+    and make sure it is valid
     """
-    if not isinstance(data,bytearray):
-        data=bytearray(data)
-    datalen=len(data)
     if startPos<0:
         startPos+=datalen
     if endPos<0:
         endPos+=datalen
-    if endPos<0 or endPos>=datalen or startPos<0 or startPos>=datalen:
-        raise IndexError('Data index [{startPos}:{endPos}] out of range [0:{datalen}]') # noqa: E501 # pylint: disable=line-too-long
+    if endPos<0 or endPos>datalen or startPos<0 or startPos>=datalen:
+        raise IndexError(f'Data index [{startPos}:{endPos}] out of range [0:{datalen}]') # noqa: E501 # pylint: disable=line-too-long
     if (endPos-startPos)%chunkSize!=0:
-        raise IndexError('Data index [{startPos}:{endPos}] is not an even multiple of chunkSize {chunkSize}') # noqa: E501 # pylint: disable=line-too-long
-    for idx in range(startPos,endPos,chunkSize):
-        ret=0
-        for i in range(idx,idx+chunkSize):
-            ret=(ret<<1)|data[i]
-        yield ret
+        raise IndexError(f'Data index [{startPos}:{endPos}] is not an even multiple of chunkSize {chunkSize}') # noqa: E501 # pylint: disable=line-too-long
+    return startPos,endPos
+
+def iterbytes(
+    data:typing.Union[bytes,bytearray],
+    startPos:int=0,endPos:int=-1,
+    chunkSize:int=1
+    )->typing.Generator[int,None,None]:
+    """
+    Utility to iterate over bytes in an array.
+
+    :chunkSize: how many bytes make up each (big endian) value
+    """
+    view=memoryview(data).cast('B')
+    startPos,endPos=_dataRange(len(view),startPos,endPos,chunkSize)
+    view=view[startPos:endPos]
+    # let C do the per-byte work wherever possible
+    if chunkSize==1:
+        yield from view
+    elif chunkSize in _CHUNK_FORMATS:
+        for (val,) in struct.iter_unpack(_CHUNK_FORMATS[chunkSize],view):
+            yield val
+    else:
+        for idx in range(0,len(view),chunkSize):
+            yield int.from_bytes(view[idx:idx+chunkSize],'big')
+
 
+def _trans(unprintableChar:int)->bytes:
+    """
+    Get a translation table that keeps printable ascii and
+    turns everything else into unprintableChar
+    """
+    tbl=_TRANS_CACHE.get(unprintableChar)
+    if tbl is None:
+        tbl=bytes((c if 0x20<=c<0x7f else unprintableChar) for c in range(256))
+        _TRANS_CACHE[unprintableChar]=tbl
+    return tbl
+
+@functools.lru_cache(maxsize=16)
+def _tableFormatter(
+    valBytes:int,valFmt:str,*,
+    positionFmt:typing.Optional[str],
+    printAscii:bool,
+    asciiBumpers:str,
+    colSep:str,
+    asciiUnprintableChar:int
+    )->typing.Callable[[memoryview,int],str]:
+    """
+    Build a function that formats a whole hexTable as
+        formatTable(dataView,rowLen)
+
+    All of the options are decided here, once, rather than
+    being checked again on every row.
+    """
+    # bake the separators into a single format for each row,
+    # that always takes (position,values,ascii)
+    # (columns that are turned off swallow their value with %.0s)
+    sep=colSep.replace('%','%%')
+    bumpers=asciiBumpers.replace('%','%%')
+    rowFmt=f'{positionFmt}{sep}%s' if positionFmt else '%.0s%s'
+    if printAscii:
+        rowFmt=f'{rowFmt}{sep}{bumpers}%s{bumpers}'
+        asciiTable=_trans(asciiUnprintableChar)
+    else:
+        rowFmt+='%.0s'
+    if valBytes==1 and valFmt in (r'%02X',r'%02x') \
+        and len(colSep)==1 and colSep.isascii() and not colSep.isalpha():
+        # the common single-byte hex case can be done for the whole
+        # table at once by bytes.hex() in C, then sliced into rows
+        upper=valFmt==r'%02X'
+        def formatTable(view:memoryview,rowLen:int)->str:
+            hexStr=view.hex(colSep)
+            if upper:
+                hexStr=hexStr.upper()
+            asc=''
+            if printAscii:
+                asc=view.tobytes().translate(asciiTable)\
+                    .decode('ascii',errors="replace")
+            # each byte is 2 hex digits plus a separator (except the last)
+            stride=rowLen*3
+            buf=io.StringIO()
+            for pos in range(0,len(view),rowLen):
+                if pos:
+                    buf.write('\n')
+                hexIdx=pos*3
+                buf.write(rowFmt%(pos,
+                    hexStr[hexIdx:hexIdx+stride-1],asc[pos:pos+rowLen]))
+            return buf.getvalue()
+    else:
+        def formatTable(view:memoryview,rowLen:int)->str:
+            buf=io.StringIO()
+            for pos in range(0,len(view),rowLen):
+                if pos:
+                    buf.write('\n')
+                chunk=view[pos:pos+rowLen]
+                vals=colSep.join([valFmt%b
+                    for b in iterbytes(chunk,0,len(chunk),valBytes)])
+                asc=''
+                if printAscii:
+                    asc=chunk.tobytes().translate(asciiTable)\
+                        .decode('ascii',errors="replace")
+                buf.write(rowFmt%(pos,vals,asc))
+            return buf.getvalue()
+    return formatTable
 
 def hexTable(data:bytes,
-    startPos:int=0,endPos:int=-0,
+    startPos:int=0,endPos:typing.Optional[int]=None,
     valBytes:int=1,valFmt=r'%02X',
-    positionFmt:typing.Optional[str]=r'%08',
+    positionFmt:typing.Optional[str]=r'%08X',
     printAscii=True,
     asciiBumpers='|',
     valsPerLine:int=16,
@@ -43,45 +147,60 @@ def hexTable(data:bytes,
     )->str:
     """
     Get a hex table capable of user-viewing
+
+    :endPos: where to stop, exclusive like a slice (default is the end)
     """
-    ret:typing.List[str]=[]
-    rowVals:typing.List[int]=[]
-    row:typing.List[str]=[]
-    for i,b in enumerate(iterbytes(data,startPos,endPos,valBytes)):
-        if i%valsPerLine==0:
-            if row:
-                if printAscii:
-                    asc=bytes([(c if (c>=0x20 and c!=0x7f) else asciiUnprintableChar) for c in rowVals]).decode('ascii',errors="ignore") # noqa: E501 # pylint: disable=line-too-long
-                    row.append(asciiBumpers+asc+asciiBumpers)
-                ret.append(colSep.join(row))
-                row=[]
-                rowVals=[]
-            if positionFmt is not None and positionFmt:
-                row.append(positionFmt%i*valBytes)
-        rowVals.append(b)
-        row.append(valFmt%b)
-    if row:
-        if printAscii:
-            asc=bytes(rowVals).decode('ascii',errors="ignore")
-            row.append(asciiBumpers+asc+asciiBumpers)
-        ret.append(colSep.join(row))
-    return '\n'.join(ret)
+    if not data:
+        return ''
+    view=memoryview(data).cast('B')
+    if endPos is None:
+        endPos=len(view)
+    startPos,endPos=_dataRange(len(view),startPos,endPos,valBytes)
+    formatTable=_tableFormatter(valBytes,valFmt,
+        positionFmt=positionFmt or None,printAscii=bool(printAscii),
+        asciiBumpers=asciiBumpers,colSep=colSep,
+        asciiUnprintableChar=asciiUnprintableChar)
+    return formatTable(view[startPos:endPos],valsPerLine*valBytes)
 
 
+# NOTE: findHexTable no longer uses this, since the nested repeats
+#   backtrack catastrophically on text that is almost a hex table.
+#   It is only kept for anyone who imported it.
 HEXTABLE_RE_TEXT=r"""(((?P<val>[0-9a-f]+)\s+){2}(?P<asc>[^\r\n$]*)\r*(\n|$))+""" # noqa: E501 # pylint: disable=line-too-long
 HEXTABLE_RE=re.compile(HEXTABLE_RE_TEXT,re.IGNORECASE)
+_HEX_TOKEN_RE=re.compile(r'[0-9a-f]+',re.IGNORECASE)
+def _isHexTableLine(line:str)->bool:
+    """
+    A hex table line starts with at least two hex values
+    """
+    tokens=line.split(None,2)
+    return len(tokens)>=2 \
+        and _HEX_TOKEN_RE.fullmatch(tokens[0]) is not None \
+        and _HEX_TOKEN_RE.fullmatch(tokens[1]) is not None
+
 def findHexTable(s:str)->typing.Optional[str]:
     """
     Find a hex table in a block of text.
 
+    This is the first run of consecutive lines that each
+    start with at least two hex values.
+
     Normally you don't need to call this as
     decodeHexTable calls it automatically.
     """
-    for m in HEXTABLE_RE.finditer(s):
-        return m.group(0)
-    return None
+    run:typing.List[str]=[]
+    for line in s.splitlines(keepends=True):
+        if _isHexTableLine(line):
+            run.append(line)
+        elif run:
+            break
+    if not run:
+        return None
+    return ''.join(run)
 
 
+_HEXTABLE_VALUES_RE=re.compile(r'[\s0-9a-fx]*',re.IGNORECASE)
+_HEX_ONLY_CHARS_RE=re.compile(r'[a-fx]',re.IGNORECASE)
 def decodeHexTable(s:str)->typing.Optional[typing.Any]:
     """
     Decode an arbitray hex table into bytes
@@ -91,37 +210,24 @@ def decodeHexTable(s:str)->typing.Optional[typing.Any]:
     if hextableStr is None:
         return hextableStr
     rows:typing.List[typing.List[str]]=[]
-    colIntBases:typing.List[int]=[10]
+    colIntBases:typing.List[int]=[]
     # parse the string into a table of strings
     # (not decoded to numbers yet since we don't know what's hex)
     for line in hextableStr.split('\n'):
-        cols:typing.List[str]=[]
-        col:typing.List[str]=[]
-        colIdx=0
-        scanningCol=False
-        for c in line.lower():
-            if c.isdigit():
-                scanningCol=True
-                if col or c!='0': # ignore leading zeroes
-                    col.append(c)
-            elif c.isalpha() and c in ('a','b','c','d','e','f','x'):
-                scanningCol=True
+        # the values are everything up to the first character
+        # that can't be part of one (eg, the ascii column)
+        m=_HEXTABLE_VALUES_RE.match(line)
+        values=m.group(0)
+        if m.end()<len(line) and values and not values[-1].isspace():
+            # the last value ran into junk, so it isn't really one
+            tokens=values.rsplit(None,1)
+            values=tokens[0] if len(tokens)>1 else ''
+        cols=values.split()
+        for colIdx,col in enumerate(cols):
+            if len(colIntBases)<=colIdx:
+                colIntBases.append(10)
+            if _HEX_ONLY_CHARS_RE.search(col) is not None:
                 colIntBases[colIdx]=16
-                if c!='x': # as in 0xff
-                    col.append(c)
-            elif c==' ':
-                if scanningCol:
-                    scanningCol=False
-                    if not col:
-                        cols.append('0')
-                    else:
-                        cols.append(''.join(col))
-                    colIdx+=1
-                    if len(colIntBases)<=colIdx:
-                        colIntBases.append(10)
-                    col=[]
-            else:
-                break
         if cols:
             rows.append(cols)
     # decode all values
@@ -152,16 +258,15 @@ def decodeHexTable(s:str)->typing.Optional[typing.Any]:
         valueTable.append(valueRow)
         firstRow=False
     # decode to bytes
-    ret:typing.List[int]=[]
+    # (the size is known by now, so fill in a preallocated buffer)
+    skip=1 if firstColIsCount else 0
+    total=sum(len(valueRow) for valueRow in valueTable)-skip*len(valueTable)
+    ret=bytearray(total)
+    idx=0
     for valueRow in valueTable:
-        firstCol=True
-        for value in valueRow:
-            if firstCol:
-                firstCol=False
-                if not firstColIsCount:
-                    ret.append(value)
-            else:
-                ret.append(value)
+        n=len(valueRow)-skip
+        ret[idx:idx+n]=valueRow[skip:]
+        idx+=n
     return bytes(ret)
 
 
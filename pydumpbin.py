@@ -8,6 +8,7 @@ https://learn.microsoft.com/en-us/cpp/build/reference/dumpbin-options?view=msvc-
 """
 import typing
 import os
+import sys
 import k_runner.osrun as osrun
 
 
@@ -29,6 +30,9 @@ class Obj:
     """
     Represents an object file
     """
+    # a .lib can hold a great many of these
+    __slots__=('name','_parseMode','symbols')
+
     def __init__(self,firstLine:str):
         fl=firstLine.split(':',1)
         self.name=fl[-1].strip()
@@ -54,9 +58,12 @@ class Obj:
                 self._parseMode=''
                 #print('done symbols')
             else:
-                items=line.split()
+                # eg "      3E8 _foo"
+                # (the location is hex, and the same names turn up in
+                # many objects, so intern them)
+                items=line.split(None,2)
                 #print('symbol',items)
-                self.symbols[items[1]]=int(items[0])
+                self.symbols[sys.intern(items[1])]=int(items[0],16)
         else:
             print(f'bogus mode "{self._parseMode}"')
         # TODO: parse each line
@@ -126,5 +133,4 @@ def cmdline(args):
 
 
 if __name__=='__main__':
-    import sys
     sys.exit(cmdline(sys.argv[1:]))
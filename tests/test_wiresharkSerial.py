@@ -0,0 +1,163 @@
+"""
+Tests for wiresharkSerial's capture worker threads
+
+(pyshark's LiveCapture is replaced with a stand-in that uses its
+event loop the same way, so neither tshark nor a serial device
+is needed)
+"""
+import typing
+import os
+import sys
+import time
+import types
+import asyncio
+import threading
+import unittest
+from unittest import mock
+sys.path.insert(0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import pyshark # type: ignore # noqa: F401 # pylint: disable=unused-import
+except ImportError:
+    # only the names need to exist, since LiveCapture gets patched
+    sys.modules['pyshark']=types.ModuleType('pyshark')
+    sys.modules['pyshark'].LiveCapture=object # type: ignore
+import wiresharkSerial # noqa: E402 # pylint: disable=wrong-import-position
+
+
+class FakeLiveCapture(list):
+    """
+    Stands in for pyshark.LiveCapture
+
+    Like pyshark, it falls back on the creating thread's event loop,
+    and runs everything with run_until_complete()
+    """
+
+    def __init__(self,interface=None,display_filter=None,eventloop=None):
+        list.__init__(self)
+        self.interface=interface
+        self.display_filter=display_filter
+        if eventloop is None:
+            try:
+                eventloop=asyncio.get_event_loop_policy().get_event_loop()
+            except RuntimeError:
+                eventloop=asyncio.new_event_loop()
+                asyncio.set_event_loop(eventloop)
+        self.eventloop=eventloop
+
+    def sniff(self,packet_count=None,timeout=None):
+        """
+        Wait out the timeout, then "capture" a packet
+        """
+        self.eventloop.run_until_complete(asyncio.sleep(timeout or 0))
+        if packet_count:
+            self.append('packet')
+
+    def clear(self):
+        """
+        Forget the captured packets
+        """
+        self.eventloop.run_until_complete(asyncio.sleep(0))
+        del self[:]
+
+    def close(self):
+        """
+        Stop capturing
+        """
+        self.eventloop.run_until_complete(asyncio.sleep(0))
+
+    __hash__=object.__hash__
+
+
+class FakeSerial:
+    """
+    A serial port that never answers
+    """
+    timeout:typing.Optional[float]=None
+
+    def write(self,data:bytes)->int:
+        """
+        Pretend to send data
+        """
+        return len(data)
+
+    def read(self,size:int)->bytes:
+        """
+        Wait out the read timeout without getting anything
+        """
+        del size
+        time.sleep(self.timeout or 0)
+        return b''
+
+
+class TestConcurrentCaptures(unittest.TestCase):
+    """
+    Two runAndCapture() calls at once
+    """
+    TIMEOUT=0.3
+
+    def setUp(self):
+        wiresharkSerial.clearCaptureCache()
+        patches=[
+            mock.patch.object(wiresharkSerial.pyshark,'LiveCapture',
+                FakeLiveCapture),
+            mock.patch.object(wiresharkSerial,'hasPySerial',True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(wiresharkSerial.clearCaptureCache)
+
+    def runConcurrently(self,searches:typing.List[bytes]):
+        """
+        Run one runAndCapture() per search, all at the same time
+
+        returns ([(timedOut,capture,commandOutput)],elapsedSeconds)
+        """
+        results:typing.List[typing.Any]=[None]*len(searches)
+        errors:typing.List[BaseException]=[]
+        def run(i:int,data:bytes):
+            try:
+                results[i]=wiresharkSerial.runAndCapture(
+                    FakeSerial(),'?',self.TIMEOUT,data)
+            except BaseException as e: # pylint: disable=broad-except
+                errors.append(e)
+        threads=[threading.Thread(target=run,args=(i,data))
+            for i,data in enumerate(searches)]
+        start=time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed=time.monotonic()-start
+        if errors:
+            raise errors[0]
+        return results,elapsed
+
+    def testRunInParallel(self):
+        """
+        Concurrent calls get their own capture, and do not queue up
+        """
+        results,elapsed=self.runConcurrently([b'a',b'b'])
+        captures=[capture for _,capture,_ in results]
+        self.assertIsNot(captures[0],captures[1])
+        self.assertEqual([timedOut for timedOut,_,_ in results],
+            [False,False])
+        self.assertLess(elapsed,self.TIMEOUT*1.9)
+
+    def testReusedCapturesOnOtherThreads(self):
+        """
+        Captures made one after the other (so on the same worker)
+        can then be used by different workers at the same time
+        """
+        for data in (b'a',b'b'):
+            _,capture,_=wiresharkSerial.runAndCapture(
+                FakeSerial(),'?',self.TIMEOUT,data)
+            wiresharkSerial.releaseCapture(capture)
+        cache=wiresharkSerial._captureCache # pylint: disable=protected-access
+        reused={id(capture) for capture in cache.values()}
+        results,_=self.runConcurrently([b'a',b'b'])
+        self.assertEqual({id(capture) for _,capture,_ in results},reused)
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -4,6 +4,9 @@ Tools for working with wireshark captures.
 requires the pyshark library
 """
 import typing
+import re
+import operator
+import itertools
 try:
     import pyshark # type: ignore
     from pyshark.packet.packet import Packet # type: ignore
@@ -22,6 +25,18 @@ except ImportError:
         """
         raise ImportError("pyshark library is required for this funtion. Install with\n\tpip install pyshark") # noqa: E501 # pylint: disable=line-too-long
 
+
+# payloads are hex bytes separated by colons, eg "0a:ff:31"
+_STRIP_COLON=str.maketrans('','',':')
+# ftdi-ft payload fields for data coming in from, and going out to, the device
+_RX_PAYLOAD='if_a_rx_payload'
+_TX_PAYLOAD='if_a_tx_payload'
+# wireshark display filter for usb bulk transfers
+USB_DATA_FILTER='usb.transfer_type == 0x03'
+# ansiColorize() rules for printing packet data
+_HDR_RE=re.compile(r"^[^\s]{4}",re.MULTILINE)
+_PACKET_COLORS=((_HDR_RE,46),("AA",95),("FF",105))
+
 def saveCapture(
     capture:pyshark.LiveCapture,
     filename:str):
@@ -41,19 +56,23 @@ def loadCapture(
     Load a serial capture
     """
     requirePyshark()
-    packet:Packet
-    packets:typing.List[Packet]=[]
-    with pyshark.FileCapture(filename) as file:
-        for packet in file:
-            if not hasattr(packet,"usb"):# or not hasattr(packet,"DATA"):
-                continue
-            if not packet.usb.transfer_type=='0x03':
-                continue
-            packets.append(packet)
+    # let tshark do the filtering, so that packets we don't want
+    # are never decoded into python objects in the first place
+    with pyshark.FileCapture(filename,display_filter=USB_DATA_FILTER) as file:
+        packets:typing.List[Packet]=list(file)
     if len(packets)<=0:
         print(f'WARN: no USB data packets found in "{filename}"')
     return packets
 
+def _decodeRun(payloads:typing.List[str])->bytes:
+    """
+    Decode a run of colon-separated hex payloads into bytes
+
+    (does the whole run in one C-level bytes.fromhex() call,
+    rather than one per packet)
+    """
+    return bytes.fromhex(''.join(payloads).translate(_STRIP_COLON))
+
 def extractPacketData(
     packets:typing.Iterable[Packet],
     includeDataIn:bool=True,
@@ -68,62 +87,83 @@ def extractPacketData(
     Returns:
         typing.Iterable[typing.Tuple[bool,bytes]]: like [(dataIn,data)]
     """
-    ret=[]
-    currentBytes=bytearray()
+    ret:typing.List[typing.Tuple[bool,bytes]]=[]
+    if not includeDataIn and not includeDataOut:
+        return ret
+    # the hex payloads of the current run of same-direction packets,
+    # which are decoded together once the direction changes
+    currentRun:typing.List[str]=[]
     currentDirectionIn=True
     endpointDirectionMask=0b10000000
+    getFtdi=operator.attrgetter("ftdi-ft")
+    # everything that depends on the endpoint is worked out the first
+    # time we see it, as the ftdi payload field to read from it
+    # (or None if that direction is not wanted)
+    payloadFields:typing.Dict[str,typing.Optional[str]]={}
     for packet in packets:
-        if not hasattr(packet,"ftdi-ft") \
-            or not hasattr(packet,"usb"):
+        # pyshark layer lookups are slow, so do each one once
+        # rather than hasattr() followed by getattr()
+        try:
+            usb=packet.usb
+            ftdi=getFtdi(packet)
+        except AttributeError:
             continue
-        endpoint=int(packet.usb.endpoint_address,base=16)
-        if endpoint&endpointDirectionMask==endpointDirectionMask:
-            directionIn=True
-            if not includeDataIn:
-                continue
-        else:
-            directionIn=False
-            if not includeDataOut:
-                continue
-        ftdi=getattr(packet,"ftdi-ft")
-        if hasattr(ftdi,"if_a_rx_payload"):
-            data=ftdi.if_a_rx_payload
-        elif hasattr(ftdi,"if_a_tx_payload"):
-            data=ftdi.if_a_tx_payload
-        else:
+        endpointAddress=usb.endpoint_address
+        try:
+            field=payloadFields[endpointAddress]
+        except KeyError:
+            endpoint=int(endpointAddress,base=16)
+            if endpoint&endpointDirectionMask==endpointDirectionMask:
+                field=_RX_PAYLOAD if includeDataIn else None
+            else:
+                field=_TX_PAYLOAD if includeDataOut else None
+            payloadFields[endpointAddress]=field
+        if field is None:
+            continue
+        data=getattr(ftdi,field,None)
+        if data is None:
             continue
+        directionIn=field==_RX_PAYLOAD
         if currentDirectionIn!=directionIn:
             # data direction change
-            if currentBytes:
-                ret.append((currentDirectionIn,bytes(currentBytes)))
-                currentBytes.clear()
+            if currentRun:
+                ret.append((currentDirectionIn,_decodeRun(currentRun)))
+                currentRun=[]
             currentDirectionIn=directionIn
-        for byte in data.split(':'):
-            currentBytes.append(int(byte,base=16))
-    if currentBytes:
-        ret.append((currentDirectionIn,bytes(currentBytes)))
+        currentRun.append(data)
+    if currentRun:
+        ret.append((currentDirectionIn,_decodeRun(currentRun)))
     return ret
 
-def getOutputData(
+def _directionData(
     source:typing.Union[
         typing.Iterable[Packet],
         typing.Iterable[typing.Tuple[bool,bytes]],
-        ]
+        ],
+    wantInput:bool
     )->bytes:
     """
-    Get a single set of bytes containing all output data joined together
+    Join together all of the data going in one direction
+
+    :source: either packets, or what extractPacketData() returns
     """
+    it=iter(source)
+    try:
+        first=next(it)
+    except StopIteration:
+        return b''
+    # put back what we peeked at
+    source=itertools.chain((first,),it)
+    if isinstance(first,Packet):
+        source=extractPacketData(source,
+            includeDataIn=wantInput,includeDataOut=not wantInput)
     ret=bytearray()
-    for testThing in source:
-        if isinstance(testThing,Packet):
-            source=extractPacketData(source,includeDataIn=False)
-        break
     for isInput,data in source:
-        if not isInput:
-            ret.extend(data)
+        if isInput==wantInput:
+            ret+=data
     return bytes(ret)
 
-def getInputData(
+def getOutputData(
     source:typing.Union[
         typing.Iterable[Packet],
         typing.Iterable[typing.Tuple[bool,bytes]],
@@ -132,15 +172,18 @@ def getInputData(
     """
     Get a single set of bytes containing all output data joined together
     """
-    ret=bytearray()
-    for testThing in source:
-        if isinstance(testThing,Packet):
-            source=extractPacketData(source,includeDataOut=False)
-        break
-    for isInput,data in source:
-        if isInput:
-            ret.extend(data)
-    return bytes(ret)
+    return _directionData(source,False)
+
+def getInputData(
+    source:typing.Union[
+        typing.Iterable[Packet],
+        typing.Iterable[typing.Tuple[bool,bytes]],
+        ]
+    )->bytes:
+    """
+    Get a single set of bytes containing all input data joined together
+    """
+    return _directionData(source,True)
 
 def printPacketDataBytes(
     packets:typing.Iterable[Packet],
@@ -148,7 +191,6 @@ def printPacketDataBytes(
     """
     print the packet data as bytes
     """
-    import re
     from byteFormatting import ansiColorize,byteText
     for directionIn,data in extractPacketData(packets):
         if directionIn:
@@ -158,11 +200,7 @@ def printPacketDataBytes(
         print(
             ansiColorize(
                 byteText(data,lineLength=lineLength,lineNumberStartAt=0xFF),
-                (
-                    (re.compile(r"^[^\s]{4}",re.MULTILINE),46),
-                    ("AA",95),
-                    ("FF",105)
-                )
+                _PACKET_COLORS
             )
             )
 
@@ -173,7 +211,6 @@ def example():
     filename=r"capture.pcapng"
     packets=loadCapture(filename)
     #printPacketDataBytes(packets,lineLength=512)
-    import re
     from byteFormatting import ansiColorize,byteText
     data=getInputData(packets)
     for sample in data.split(b'\xff'):
@@ -184,11 +221,7 @@ def example():
                     lineLength=9999,
                     lineNumberWidth=0,
                     ),
-                (
-                    (re.compile(r"^[^\s]{4}",re.MULTILINE),46),
-                    ("AA",95),
-                    ("FF",105)
-                )
+                _PACKET_COLORS
             )
             )
         print()
@@ -6,12 +6,19 @@ NOTE: this will be equivilent to the wireshark filter:
    (usb.endpoint_address==0x81&&usb.endpoint_address.direction=="IN")
 """
 import typing
+import re
 import time
 import threading
+import functools
+import collections
+import atexit
+import asyncio
+import weakref
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pyshark # type: ignore
-from pyshark.packet.packet import Packet # type: ignore
 try:
-    from serial import Serial # type: ignore
+    from serial import Serial,SerialException # type: ignore
     hasPySerial=True
 except ImportError:
     # pyserial not found. some functions may be limited
@@ -19,6 +26,10 @@ except ImportError:
         """
         Dummy stand-in for serial.Serial
         """
+    class SerialException(IOError): # type: ignore
+        """
+        Dummy stand-in for serial.SerialException
+        """
     hasPySerial=False
 
 if __name__=='__main__':
@@ -28,45 +39,369 @@ if __name__=='__main__':
     sys.path.append(os.path.dirname(d))
 
 
+_logger=logging.getLogger(__name__)
+
+# regexes are matched against the raw payload bytes
+RegexLike=typing.Union[str,bytes,typing.Pattern]
+# the ftdi fields holding the serial data
+_PAYLOAD_FIELDS=("ftdi-ft.if_a_rx_payload","ftdi-ft.if_a_tx_payload")
+SERIAL_DATA_FILTER=' || '.join(_PAYLOAD_FIELDS)
+
+@functools.lru_cache(maxsize=256)
+def _compile(
+    pattern:typing.Union[str,bytes],
+    flags:int=0
+    )->typing.Pattern[bytes]:
+    """
+    Compile a regex that can search payload bytes
+    (cached, so callers can pass the same string over and over)
+    """
+    if isinstance(pattern,str):
+        pattern=pattern.encode('utf-8')
+    return re.compile(pattern,flags)
+
+def _bytesRegex(regex:RegexLike)->typing.Pattern[bytes]:
+    """
+    Get a bytes regex from a pattern string or any compiled regex
+    """
+    if isinstance(regex,(str,bytes)):
+        return _compile(regex)
+    if isinstance(regex.pattern,str):
+        # re.UNICODE is not allowed for bytes patterns
+        return _compile(regex.pattern,regex.flags&~re.UNICODE)
+    return regex
+
+def precompile(patterns:typing.Iterable[RegexLike])->None:
+    """
+    Check regexes ahead of time, so that a bad one raises
+    re.error (or ValueError for flags a display filter
+    cannot carry) now rather than when it is used
+
+    NOTE: the searching itself is done by tshark, so this
+        does not make the captures any faster
+    """
+    for pattern in patterns:
+        regex=_bytesRegex(pattern)
+        _filterRegex(regex.pattern,regex.flags)
+
+def _filterString(s:bytes)->str:
+    """
+    Quote bytes as a display filter string literal
+    """
+    return '"'+''.join([f'\\x{b:02x}' for b in s])+'"'
+
+# python regex flags and their PCRE inline equivalents
+# (besides IGNORECASE, which is handled separately)
+_INLINE_FLAGS=((re.MULTILINE,'m'),(re.DOTALL,'s'),(re.VERBOSE,'x'))
+# flags that can be carried over, or that make no difference
+# to a bytes pattern
+_FILTER_FLAGS=re.IGNORECASE|re.MULTILINE|re.DOTALL|re.VERBOSE\
+    |re.ASCII|re.DEBUG
+
+def _filterRegex(pattern:bytes,flags:int)->str:
+    """
+    Turn a python regex into a display filter "matches" string literal
+
+    NOTE: tshark uses PCRE, which understands most anything python's
+        re does, but is not exactly the same
+    """
+    unsupported=flags&~_FILTER_FLAGS
+    if unsupported:
+        raise ValueError(
+            f'regex flags {re.RegexFlag(unsupported)!r} '
+            'cannot be used in a display filter')
+    # carry over the flags that mean something to PCRE
+    # (matches is caseless unless told otherwise)
+    inlineFlags='' if flags&re.IGNORECASE else '-i'
+    for flag,letter in _INLINE_FLAGS:
+        if flags&flag:
+            inlineFlags=letter+inlineFlags
+    s=pattern.decode('utf-8',errors='backslashreplace')
+    s=s.replace('\\','\\\\').replace('"','\\"')
+    # (a raw newline would end the filter string, and matters
+    # in verbose patterns, so keep them as escapes)
+    s=s.replace('\n','\\n').replace('\r','\\r').replace('\t','\\t')
+    if inlineFlags:
+        s=f'(?{inlineFlags}){s}'
+    return f'"{s}"'
+
+@functools.lru_cache(maxsize=32)
+def _buildFilter(
+    data:typing.Optional[bytes],
+    pattern:typing.Optional[bytes],
+    flags:int
+    )->str:
+    """
+    Build the display filter for a (canonicalized) search
+
+    (cached, since the same searches tend to be made over and over,
+    and an identical string also lets the capture be reused)
+    """
+    tests=[]
+    if data is not None:
+        tests.append('contains '+_filterString(data))
+    if pattern is not None:
+        tests.append('matches '+_filterRegex(pattern,flags))
+    if not tests:
+        return SERIAL_DATA_FILTER
+    return ' || '.join([f'{field} {test}'
+        for test in tests for field in _PAYLOAD_FIELDS])
+
+def _displayFilter(
+    data:typing.Optional[bytes]=None,
+    regex:typing.Optional[RegexLike]=None
+    )->str:
+    """
+    Build a display filter for serial data packets,
+    optionally only the ones containing data or matching regex
+    """
+    if data is not None:
+        data=bytes(data)
+    if regex is None:
+        return _buildFilter(data,None,0)
+    regex=_bytesRegex(regex)
+    return _buildFilter(data,regex.pattern,regex.flags)
+
+# LiveCaptures that are not in use, by (interface,displayFilter)
+# least recently used first
+_captureCache:typing.OrderedDict[typing.Tuple[str,str],pyshark.LiveCapture]\
+    =collections.OrderedDict()
+CAPTURE_CACHE_SIZE=4
+_captureCacheLock=threading.Lock()
+_captureCacheAtexit=False
+# what each capture handed out by _getCapture() was made for
+_captureKeys:typing.MutableMapping[pyshark.LiveCapture,typing.Tuple[str,str]]\
+    =weakref.WeakKeyDictionary()
+
+def _getCapture(interface:str,displayFilter:str)->pyshark.LiveCapture:
+    """
+    Get an empty LiveCapture for this interface and filter,
+    reusing one from an earlier call if there is one
+
+    (a new LiveCapture has to set up its event loop and ask tshark
+    for its version again, which is slow)
+
+    NOTE: each capture gets its own event loop, rather than the one
+        belonging to whichever thread made it, so that it can be
+        handed from thread to thread, and closed from any of them
+    NOTE: when finished, hand it back with releaseCapture()
+    """
+    global _captureCacheAtexit # pylint: disable=global-statement
+    key=(interface,displayFilter)
+    with _captureCacheLock:
+        # take it out while in use, so two threads cannot share one
+        capture=_captureCache.pop(key,None)
+        if not _captureCacheAtexit:
+            atexit.register(clearCaptureCache)
+            _captureCacheAtexit=True
+    if capture is None:
+        capture=pyshark.LiveCapture(
+            interface=interface,display_filter=displayFilter,
+            eventloop=asyncio.new_event_loop())
+        with _captureCacheLock:
+            _captureKeys[capture]=key
+        return capture
+    capture.clear()
+    return capture
+
+def releaseCapture(capture:pyshark.LiveCapture)->None:
+    """
+    Hand back a capture from captureSerial() or runAndCapture()
+    once you are done with it, so that later calls can reuse it
+
+    (if that makes too many, the least recently used gets closed)
+
+    NOTE: the capture is cleared when it gets reused, so do not
+        touch it after this
+    """
+    evicted=[]
+    with _captureCacheLock:
+        key=_captureKeys.get(capture)
+        if key is None:
+            # not one of ours
+            return
+        old=_captureCache.pop(key,None)
+        if old is not None and old is not capture:
+            evicted.append(old)
+        _captureCache[key]=capture
+        while len(_captureCache)>CAPTURE_CACHE_SIZE:
+            evicted.append(_captureCache.popitem(last=False)[1])
+    for old in evicted:
+        _discardCapture(old)
+
+def _discardCapture(capture:pyshark.LiveCapture)->None:
+    """
+    Close a capture that is no longer going to be reused,
+    along with its event loop
+
+    (it is out of the cache by now, so no other thread can be
+    using its loop)
+    """
+    try:
+        capture.close()
+    finally:
+        capture.eventloop.close()
+
+def clearCaptureCache():
+    """
+    Close all of the captures being kept for reuse
+    """
+    with _captureCacheLock:
+        captures=list(_captureCache.values())
+        _captureCache.clear()
+    for capture in captures:
+        _discardCapture(capture)
+
 def captureSerial(
     timeout:float,
     data:typing.Optional[bytes]=None,
-    regex:typing.Optional[typing.Pattern]=None,
+    regex:typing.Optional[RegexLike]=None,
     interface:str="USBPcap2"
     )->typing.Tuple[bool,pyshark.LiveCapture]:
     """
     Capture serial data
 
+    :data: bytes to look for in the serial data
+    :regex: regex to search the serial data for
+        (can be a string, which will be compiled and cached)
+
+    NOTE: when looking for data or regex, the capture only holds
+        the packet that matched
+    NOTE: pass the capture to releaseCapture() when done with it,
+        so that later calls can reuse it
+
     returns (timeoutOccourred,capture)
     """
-    capture=pyshark.LiveCapture(
-        interface=interface,
-        display_filter="ftdi-ft.if_a_rx_payload || ftdi-ft.if_a_tx_payload")
-    startTime=time.time()
-    capture.sniff(timeout=timeout)
+    # let tshark do the looking, so that only the packets we want
+    # ever make it back to python
+    displayFilter=_displayFilter(data,regex)
+    capture=_getCapture(interface,displayFilter)
+    try:
+        if data is None and regex is None:
+            # nothing to look for, so just capture until the timeout
+            capture.sniff(timeout=timeout)
+        else:
+            # everything that gets through the filter is a hit,
+            # so stop at the first one, rather than waiting out
+            # the timeout
+            capture.sniff(packet_count=1,timeout=timeout)
+    except BaseException:
+        # the caller never gets it, so it can be reused right away
+        capture.close()
+        releaseCapture(capture)
+        raise
     capture.close()
-    packet:Packet
-    for packet in capture:
-        if data is not None and packet.find(data):
-            return False,capture
-        if regex is not None and regex.match(data) is not None:
-            return False,capture
-        if time.time()-startTime>=timeout:
-            break
-    return True,capture
+    if data is None and regex is None:
+        return True,capture
+    return len(capture)==0,capture
 
-def runAndCapture(
+# runs the captures for runAndCapture(), so that its threads stick
+# around between calls
+# (one worker per concurrent caller, up to this many - a capture can
+# move between workers because it has its own event loop, rather
+# than the loop of the thread that made it, and the cache only ever
+# hands it to one of them at a time)
+CAPTURE_WORKERS=32
+_captureExecutor=ThreadPoolExecutor(
+    max_workers=CAPTURE_WORKERS,thread_name_prefix='captureSerial')
+
+def _captureUntil(
+    deadlineNs:int,
+    data:typing.Optional[bytes],
+    regex:typing.Optional[RegexLike],
+    interface:str
+    )->typing.Tuple[bool,pyshark.LiveCapture]:
+    """
+    captureSerial() for whatever time is left once a worker gets to it
+
+    :deadlineNs: a time.monotonic_ns() time
+    """
+    timeout=max(0,deadlineNs-time.monotonic_ns())/1e9
+    return captureSerial(timeout,data,regex,interface)
+
+def _readResponse(
+    serial:Serial,
+    deadlineNs:int,
+    idleTime:float,
+    chunkSize:int=4096,
+    bufferSize:int=65536
+    )->bytes:
+    """
+    Read whatever comes back from the serial port, in big chunks,
+    until it has gone quiet for idleTime (or the deadline passes)
+
+    :deadlineNs: a time.monotonic_ns() time
+    :bufferSize: how much room to start with
+        (it grows if the response turns out to be bigger)
+    """
+    oldTimeout=serial.timeout
+    # short reads, so that we notice when it goes quiet
+    serial.timeout=min(idleTime,0.05)
+    # read straight into one buffer, rather than collecting new
+    # bytes objects and copying them together
+    buf=bytearray(max(bufferSize,chunkSize))
+    view=memoryview(buf)
+    readinto=getattr(serial,'readinto',None)
+    idleNs=int(idleTime*1e9)
+    n=0
+    try:
+        now=time.monotonic_ns()
+        lastData=now
+        while now<deadlineNs:
+            if len(buf)-n<chunkSize:
+                view.release() # (a bytearray cannot grow while viewed)
+                buf.extend(bytes(len(buf)))
+                view=memoryview(buf)
+            if readinto is not None:
+                got=readinto(view[n:n+chunkSize]) or 0
+            else:
+                chunk=serial.read(chunkSize)
+                got=len(chunk)
+                view[n:n+got]=chunk
+            now=time.monotonic_ns()
+            if got:
+                n+=got
+                lastData=now
+            elif n and now-lastData>=idleNs:
+                break
+    finally:
+        serial.timeout=oldTimeout
+    ret=bytes(view[:n])
+    view.release()
+    return ret
+
+def _commandBytes(command:typing.Union[str,bytes])->bytes:
+    """
+    Get what to send for a command
+
+    Strings get a newline added and are encoded,
+    bytes are sent exactly as they are
+    """
+    if isinstance(command,(bytes,bytearray)):
+        return bytes(command)
+    return (command+'\n').encode('utf-8')
+
+def runAndCaptureMany(
     serial:Serial,
-    command:str,
+    commands:typing.Iterable[typing.Union[str,bytes]],
     timeout:float,
     data:typing.Optional[bytes]=None,
-    regex:typing.Optional[typing.Pattern]=None,
-    interface:str="USBPcap2"
-    )->typing.Tuple[bool,pyshark.LiveCapture,str]:
+    regex:typing.Optional[RegexLike]=None,
+    *,
+    interface:str="USBPcap2",
+    idleTime:float=0.5
+    )->typing.Tuple[bool,pyshark.LiveCapture,typing.List[bytes]]:
     """
-    Run a serial command and capture the output
+    Run a series of serial commands, one after the other,
+    all under a single capture (so tshark only gets started once)
 
-    returns (timedOut,capture,commandOutput)
+    :timeout: for the whole series, not each command
+    :idleTime: each command's output is done once the serial port
+        has been quiet for this long
+
+    NOTE: pass the capture to releaseCapture() when done with it
+
+    returns (timedOut,capture,commandOutputs)
     """
     if not hasPySerial:
         msg=['Cannot use runAndCapture()',
@@ -74,24 +409,58 @@ def runAndCapture(
             'install it with',
             '  pip install pyserial']
         raise ImportError('\n'.join(msg))
-    functionResults={}
-    def captureThreadFn():
-        timedOut,capture=captureSerial(timeout,data,regex,interface)
-        functionResults["timedOut"]=timedOut
-        functionResults["capture"]=capture
-    thread=threading.Thread(target=captureThreadFn)
-    thread.start()
-    try:
-        serial.write(command+'\n')
-        time.sleep(0.5)
-        commandResponse=serial.read(serial.in_waiting())
-    except Exception as e:
-        print(e)
-    thread.join()
-    return (
-        functionResults["timedOut"], # type: ignore
-        functionResults["capture"], # type: ignore
-        commandResponse)
+    commandBytes=[_commandBytes(command) for command in commands]
+    # the capture and the reads share one deadline
+    deadlineNs=time.monotonic_ns()+int(timeout*1e9)
+    # the capture runs on a worker thread while we talk to the device
+    # (the timeout is worked out once it starts, so that time spent
+    # waiting for a free worker comes out of it)
+    future=_captureExecutor.submit(_captureUntil,
+        deadlineNs,data,regex,interface)
+    commandResponses:typing.List[bytes]=[]
+    for command in commandBytes:
+        try:
+            serial.write(command)
+        except SerialException:
+            _logger.exception("serial write of %r failed",command)
+            raise
+        try:
+            commandResponses.append(
+                _readResponse(serial,deadlineNs,idleTime))
+        except SerialException:
+            _logger.exception("serial read after %r failed",command)
+            raise
+    # (this also passes along anything the capture raised)
+    timedOut,capture=future.result()
+    return timedOut,capture,commandResponses
+
+def runAndCapture(
+    serial:Serial,
+    command:typing.Union[str,bytes],
+    timeout:float,
+    data:typing.Optional[bytes]=None,
+    regex:typing.Optional[RegexLike]=None,
+    interface:str="USBPcap2",
+    *,
+    idleTime:float=0.5
+    )->typing.Tuple[bool,pyshark.LiveCapture,bytes]:
+    """
+    Run a serial command and capture the output
+
+    :command: a string gets a newline added,
+        bytes are sent exactly as they are
+    :idleTime: the command output is done once the serial port
+        has been quiet for this long
+
+    NOTE: pass the capture to releaseCapture() when done with it
+
+    returns (timedOut,capture,commandOutput)
+    """
+    timedOut,capture,commandResponses=runAndCaptureMany(
+        serial,(command,),timeout,data,regex,
+        interface=interface,idleTime=idleTime)
+    commandResponse=commandResponses[0] if commandResponses else b''
+    return timedOut,capture,commandResponse
 
 def example():
     """
@@ -103,6 +472,7 @@ def example():
     timeout,capture,_=runAndCapture(serial,"?",10)
     for packet in capture:
         print(packet)
+    releaseCapture(capture)
     if timeout:
         print('[timeout]')
 